@@ -3,12 +3,35 @@ ClipGenius Backend
 A simple API for analyzing YouTube videos and finding interesting moments.
 """
 
-from fastapi import FastAPI, HTTPException
+import os
+import json
+import asyncio
+import secrets
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from fastapi import FastAPI, Header, HTTPException, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
 from services.youtube import extract_video_id, fetch_transcript
-from services.ai import analyze_transcript
-from services.database import save_analysis, get_cached_analysis
+from services.ai import (
+    analyze_transcript,
+    stream_transcript_analysis,
+    warm_up,
+    start_client,
+    close_client,
+)
+from services.database import (
+    save_analysis,
+    get_cached_analysis,
+    save_transcript,
+    get_cached_transcript,
+    get_cached_failure,
+    cache_failure,
+    purge_failures,
+)
 
 # Create FastAPI app
 app = FastAPI(
@@ -27,6 +50,45 @@ app.add_middleware(
 )
 
 
+# Shared secret for the /api/admin routes, sent as the X-Admin-Key header.
+# The admin routes are disabled if it isn't set.
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+
+
+# Worker processes for YouTube transcript fetches, created on startup.
+# This is the total for the whole server: it is split across the uvicorn
+# workers (WEB_CONCURRENCY), with at least one process each.
+TRANSCRIPT_WORKERS = 4
+_transcript_pool: ProcessPoolExecutor | None = None
+
+
+def _new_transcript_pool() -> ProcessPoolExecutor:
+    """Create the transcript worker pool for this server worker."""
+    server_workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+    # "spawn" rather than fork: forking a running (multithreaded) server
+    # can deadlock the child
+    return ProcessPoolExecutor(
+        max_workers=max(1, TRANSCRIPT_WORKERS // server_workers),
+        mp_context=multiprocessing.get_context("spawn"),
+    )
+
+
+@app.on_event("startup")
+async def startup():
+    """Open shared resources (HTTP client, transcript worker pool)."""
+    global _transcript_pool
+    await start_client()
+    _transcript_pool = _new_transcript_pool()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    """Release shared resources."""
+    await close_client()
+    if _transcript_pool is not None:
+        _transcript_pool.shutdown(cancel_futures=True)
+
+
 # Request/Response Models
 class AnalyzeRequest(BaseModel):
     """Request body for /api/analyze endpoint"""
@@ -40,6 +102,11 @@ class TimestampItem(BaseModel):
     reason: str
 
 
+class AIReply(BaseModel):
+    """The JSON the AI is asked to reply with"""
+    timestamps: list[TimestampItem] = []
+
+
 class AnalyzeResponse(BaseModel):
     """Response from /api/analyze endpoint"""
     success: bool
@@ -50,6 +117,179 @@ class AnalyzeResponse(BaseModel):
     error: str | None = None
 
 
+class BatchAnalyzeRequest(BaseModel):
+    """Request body for /api/analyze/batch endpoint"""
+    urls: list[str] = Field(min_length=1, max_length=20)
+
+
+class BatchAnalyzeResponse(BaseModel):
+    """Response from /api/analyze/batch endpoint (one result per URL)"""
+    results: list[AnalyzeResponse]
+
+
+# Analysis pipeline
+# Max analyses running at once across all batch requests (AI rate limits)
+BATCH_CONCURRENCY = 8
+_batch_semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+# Analyses in progress by video ID, so concurrent requests for the same
+# video wait on one analysis (and one AI call) instead of each running it
+_inflight: dict[str, asyncio.Task] = {}
+
+# References to fire-and-forget tasks, so they aren't garbage collected
+_background_tasks: set[asyncio.Task] = set()
+
+
+async def _get_transcript(video_id: str) -> dict:
+    """
+    Get the transcript for a video, from the cache or from YouTube.
+    Raises HTTPException if it can't be fetched.
+    """
+    cached_transcript = get_cached_transcript(video_id)
+    if cached_transcript.get("found"):
+        return cached_transcript["data"]
+    
+    # Don't go back to YouTube for a video that just failed
+    failure = get_cached_failure(video_id)
+    if failure:
+        raise HTTPException(
+            status_code=400,
+            detail=failure["error"],
+        )
+    
+    # Connect to the AI service while the transcript downloads
+    warm_up()
+    
+    # (the YouTube client is blocking and parses in Python, so run it
+    # in a worker process to keep it off the event loop and the GIL)
+    global _transcript_pool
+    pool = _transcript_pool
+    loop = asyncio.get_running_loop()
+    try:
+        transcript_result = await loop.run_in_executor(pool, fetch_transcript, video_id)
+    except BrokenProcessPool:
+        # A worker died; replace the pool (unless a concurrent request
+        # already did) so later fetches still work
+        if _transcript_pool is pool:
+            pool.shutdown(wait=False)
+            _transcript_pool = _new_transcript_pool()
+        transcript_result = {
+            "success": False,
+            "error": "Failed to fetch transcript: the worker process crashed. Please try again.",
+        }
+    if not transcript_result["success"]:
+        cache_failure(video_id, transcript_result)
+        raise HTTPException(
+            status_code=400,
+            detail=transcript_result["error"],
+        )
+    save_transcript(
+        video_id,
+        transcript_result["transcript"],
+        transcript_result["text"],
+    )
+    return transcript_result
+
+
+def _save_results(video_id: str, ai_result: dict) -> AnalyzeResponse:
+    """
+    Validate the AI's timestamps and save them to the database.
+    Raises HTTPException if the AI call failed or returned bad data.
+    """
+    if not ai_result["success"]:
+        raise HTTPException(
+            status_code=500,
+            detail=ai_result["error"],
+        )
+    
+    # Parse and validate the reply in one pass
+    try:
+        reply = AIReply.model_validate_json(ai_result["json_bytes"])
+    except ValidationError as e:
+        if e.errors()[0]["type"] == "json_invalid":
+            detail = f"Failed to parse AI response: {e.errors()[0]['msg']}"
+        else:
+            detail = "AI returned timestamps in an unexpected format. Please try again."
+        raise HTTPException(status_code=500, detail=detail)
+    
+    video_title = f"YouTube Video ({video_id})"  # We could fetch actual title if needed
+    response = AnalyzeResponse(
+        success=True,
+        video_id=video_id,
+        video_title=video_title,
+        timestamps=reply.timestamps,
+        cached=False,
+    )
+    
+    # Save to database (don't fail if this doesn't work)
+    # Save the validated timestamps, since cache hits skip validation
+    save_analysis(
+        video_id,
+        video_title,
+        [item.model_dump() for item in response.timestamps],
+    )
+    
+    return response
+
+
+async def _analyze(video_id: str) -> AnalyzeResponse:
+    """
+    Fetch the transcript, analyze it with AI and save the results.
+    Raises HTTPException if any step fails.
+    """
+    transcript_result = await _get_transcript(video_id)
+    ai_result = await analyze_transcript(
+        transcript_result["text"],
+        transcript_result["transcript"],
+    )
+    return _save_results(video_id, ai_result)
+
+
+async def _run_analysis(video_id: str) -> AnalyzeResponse:
+    """
+    Run the analysis for a video, sharing it with any request already
+    analyzing the same video instead of starting a second one.
+    Raises HTTPException if any step fails.
+    """
+    task = _inflight.get(video_id)
+    if task is None:
+        task = asyncio.create_task(_analyze(video_id))
+        _inflight[video_id] = task
+        task.add_done_callback(lambda _: _inflight.pop(video_id, None))
+    
+    # (shielded so one client disconnecting doesn't cancel it for the others)
+    return await asyncio.shield(task)
+
+
+def _cached_result(cached: dict) -> AnalyzeResponse:
+    """
+    Build the response for a cache hit from its stored (pre-serialized)
+    response, so every endpoint answers cache hits the same way.
+    """
+    return AnalyzeResponse.model_validate_json(cached["response"])
+
+
+def _ndjson(item: dict) -> bytes:
+    """Encode one line of a streamed (newline-delimited JSON) response."""
+    return json.dumps(item).encode() + b"\n"
+
+
+async def _run_batch_item(video_id: str) -> AnalyzeResponse:
+    """Run one batch analysis, turning failures into an error result."""
+    async with _batch_semaphore:
+        try:
+            return await _run_analysis(video_id)
+        except HTTPException as e:
+            return AnalyzeResponse(success=False, video_id=video_id, error=e.detail)
+        except Exception as e:
+            # Anything unexpected still only fails this URL, not the batch
+            return AnalyzeResponse(
+                success=False,
+                video_id=video_id,
+                error=f"Analysis failed: {str(e)}",
+            )
+
+
 # API Endpoints
 @app.get("/")
 def root():
@@ -61,14 +301,14 @@ def root():
 
 
 @app.post("/api/analyze", response_model=AnalyzeResponse)
-def analyze_video(request: AnalyzeRequest):
+async def analyze_video(request: AnalyzeRequest):
     """
     Analyze a YouTube video and return interesting moments with timestamps.
     
     Steps:
     1. Extract video ID from URL
     2. Check if we have cached results
-    3. Fetch transcript from YouTube
+    3. Fetch transcript from YouTube (or the transcript cache)
     4. Send to AI for analysis
     5. Save results to database
     6. Return results
@@ -83,54 +323,113 @@ def analyze_video(request: AnalyzeRequest):
         )
     
     # Step 2: Check for cached results
+    # (cache hits return the stored response as-is, no re-validation)
     cached = get_cached_analysis(video_id)
     if cached.get("found"):
-        data = cached["data"]
-        return AnalyzeResponse(
-            success=True,
-            video_id=video_id,
-            video_title=data.get("video_title", "Unknown"),
-            timestamps=data.get("timestamps", []),
-            cached=True,
-        )
+        return Response(content=cached["response"], media_type="application/json")
     
-    # Step 3: Fetch transcript
-    transcript_result = fetch_transcript(video_id)
-    if not transcript_result["success"]:
+    # Steps 3-5: Fetch transcript, analyze and save
+    return await _run_analysis(video_id)
+
+
+@app.post("/api/analyze/stream")
+async def analyze_video_stream(request: AnalyzeRequest):
+    """
+    Same as /api/analyze, but streams the AI's reply as it is written.
+    
+    The response is newline-delimited JSON: {"partial": "..."} lines with
+    pieces of the reply, then one final line with the full result (the
+    /api/analyze response fields plus "done": true). Cached videos get
+    just the final line. Results are still saved to the database.
+    """
+    video_id = extract_video_id(request.youtube_url)
+    if not video_id:
         raise HTTPException(
             status_code=400,
-            detail=transcript_result["error"],
+            detail="Invalid YouTube URL. Please provide a valid YouTube video link.",
         )
     
-    # Step 4: Analyze with AI
-    ai_result = analyze_transcript(
-        transcript_result["text"],
-        transcript_result["transcript"],
-    )
-    if not ai_result["success"]:
-        raise HTTPException(
-            status_code=500,
-            detail=ai_result["error"],
+    cached = get_cached_analysis(video_id)
+    if cached.get("found"):
+        result = _cached_result(cached)
+        return StreamingResponse(
+            iter([_ndjson({**result.model_dump(), "done": True})]),
+            media_type="application/x-ndjson",
         )
     
-    timestamps = ai_result["timestamps"]
-    video_title = f"YouTube Video ({video_id})"  # We could fetch actual title if needed
+    # Fetch the transcript before streaming starts, so failures are
+    # still reported with a normal error status
+    transcript_result = await _get_transcript(video_id)
     
-    # Step 5: Save to database (don't fail if this doesn't work)
-    save_analysis(video_id, video_title, timestamps)
+    # The AI stream is read by a background task that feeds a queue, so it
+    # runs to the end (and saves the result) even if the client disconnects
+    queue: asyncio.Queue[dict | None] = asyncio.Queue()
     
-    # Step 6: Return results
-    return AnalyzeResponse(
-        success=True,
-        video_id=video_id,
-        video_title=video_title,
-        timestamps=timestamps,
-        cached=False,
+    async def consume_ai_stream():
+        try:
+            async for event in stream_transcript_analysis(
+                transcript_result["text"],
+                transcript_result["transcript"],
+            ):
+                if "partial" not in event:
+                    try:
+                        result = _save_results(video_id, event)
+                    except HTTPException as e:
+                        result = AnalyzeResponse(success=False, video_id=video_id, error=e.detail)
+                    event = {**result.model_dump(), "done": True}
+                queue.put_nowait(event)
+        finally:
+            queue.put_nowait(None)
+    
+    task = asyncio.create_task(consume_ai_stream())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    
+    async def generate():
+        while (event := await queue.get()) is not None:
+            yield _ndjson(event)
+    
+    return StreamingResponse(generate(), media_type="application/x-ndjson")
+
+
+@app.post("/api/analyze/batch", response_model=BatchAnalyzeResponse)
+async def analyze_batch(request: BatchAnalyzeRequest):
+    """
+    Analyze several YouTube videos at once.
+    
+    Cached videos are answered straight away; the rest are analyzed
+    concurrently (each video once, even if its URL is repeated).
+    Failures are reported per URL instead of failing the whole batch.
+    """
+    results: dict[str, AnalyzeResponse] = {}
+    video_ids = [extract_video_id(url) for url in request.urls]
+    
+    misses = []
+    for video_id in dict.fromkeys(video_ids):
+        if not video_id:
+            continue
+        cached = get_cached_analysis(video_id)
+        if cached.get("found"):
+            results[video_id] = _cached_result(cached)
+        else:
+            misses.append(video_id)
+    
+    analyzed = await asyncio.gather(*[_run_batch_item(video_id) for video_id in misses])
+    results.update(zip(misses, analyzed))
+    
+    return BatchAnalyzeResponse(
+        results=[
+            results[video_id] if video_id else AnalyzeResponse(
+                success=False,
+                error="Invalid YouTube URL. Please provide a valid YouTube video link.",
+            )
+            for video_id in video_ids
+        ],
     )
 
 
 @app.get("/api/results/{video_id}", response_model=AnalyzeResponse)
-def get_results(video_id: str):
+async def get_results(video_id: str):
     """
     Get cached analysis results for a video.
     Returns 404 if not found.
@@ -143,17 +442,53 @@ def get_results(video_id: str):
             detail="No analysis found for this video. Use /api/analyze to analyze it first.",
         )
     
-    data = cached["data"]
-    return AnalyzeResponse(
-        success=True,
-        video_id=video_id,
-        video_title=data.get("video_title", "Unknown"),
-        timestamps=data.get("timestamps", []),
-        cached=True,
-    )
+    return Response(content=cached["response"], media_type="application/json")
+
+
+def _check_admin_key(admin_key: str | None) -> None:
+    """Raise HTTPException unless the request has the admin API key."""
+    if not ADMIN_API_KEY:
+        raise HTTPException(
+            status_code=403,
+            detail="Admin API is disabled. Set ADMIN_API_KEY in your .env file to enable it.",
+        )
+    if not admin_key or not secrets.compare_digest(admin_key, ADMIN_API_KEY):
+        raise HTTPException(
+            status_code=401,
+            detail="Invalid or missing X-Admin-Key header.",
+        )
+
+
+@app.delete("/api/admin/failures")
+async def clear_failures(
+    video_id: str | None = None,
+    x_admin_key: str | None = Header(default=None),
+):
+    """
+    Forget remembered transcript failures so videos can be retried now.
+    Pass ?video_id=... to clear a single video, or nothing to clear all.
+    Requires the X-Admin-Key header.
+    """
+    _check_admin_key(x_admin_key)
+    return {"purged": purge_failures(video_id)}
 
 
 # Run with: uvicorn main:app --reload
 if __name__ == "__main__":
+    import sys
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+
+    # One worker per core by default. Each worker opens its own HTTP client
+    # (startup hook) and SQLite connection (on first use), so nothing is
+    # shared across processes. uvloop is not available on Windows.
+    # WEB_CONCURRENCY is exported so workers can size their transcript pools.
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=workers,
+        loop="asyncio" if sys.platform == "win32" else "uvloop",
+        http="httptools",
+    )
@@ -4,59 +4,86 @@ Handles communication with OpenRouter to analyze video transcripts.
 """
 
 import os
+import re
 import json
-import requests
+import math
+import time
+import asyncio
+import httpx
+from collections.abc import AsyncIterator
 from dotenv import load_dotenv
 
+# orjson is much faster at parsing; fall back to the standard library
+try:
+    from orjson import dumps as _json_dumps, loads as _json_loads
+except ImportError:
+    def _json_dumps(value) -> bytes:
+        return json.dumps(value, ensure_ascii=False).encode()
+
+    _json_loads = json.loads
+
 # Load environment variables
 load_dotenv()
 
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_MODELS_URL = "https://openrouter.ai/api/v1/models"
 
-def analyze_transcript(transcript_text: str, transcript_segments: list) -> dict:
-    """
-    Send transcript to OpenRouter AI to find interesting moments.
-    
-    Args:
-        transcript_text: The full transcript as plain text
-        transcript_segments: List of segments with timing info
-        
-    Returns:
-        Dictionary with success status and timestamps or error
-    """
-    if not OPENROUTER_API_KEY:
-        return {
-            "success": False,
-            "error": "OpenRouter API key not configured. Please add OPENROUTER_API_KEY to your .env file.",
-        }
-    
-    try:
-        # Create the prompt
-        prompt = f"""You are a video content analyst. Analyze this YouTube video transcript and find the most interesting, important, or notable moments.
+API_KEY_MISSING = {
+    "success": False,
+    "error": "OpenRouter API key not configured. Please add OPENROUTER_API_KEY to your .env file.",
+}
+
+# Shared HTTP client, created on app startup (see start_client).
+# Reusing it keeps the connection to OpenRouter alive between requests,
+# so only the first call pays for the TCP + TLS handshake.
+_client: httpx.AsyncClient | None = None
+
+# Gateway errors worth retrying, and how many times
+RETRY_STATUSES = {502, 503, 504}
+MAX_RETRIES = 2
+RETRY_BACKOFF = 0.3
+
+# How long idle connections stay in the pool. A connection used (or
+# warmed up) more recently than this is assumed to still be open.
+KEEPALIVE_EXPIRY = 30
+
+# Pulls the JSON object out of the first ```json ... ``` block if the AI adds one
+CODE_FENCE_PATTERN = re.compile(r"```(?:json)?\s*(\{.*?\})\s*```", re.DOTALL)
+
+# Token budget for the transcript part of the prompt (~4 characters per token)
+TRANSCRIPT_TOKEN_BUDGET = 6000
+
+HEADERS = {
+    "Authorization": f"Bearer {OPENROUTER_API_KEY}",
+    "Content-Type": "application/json",
+    "HTTP-Referer": "http://localhost:8000",
+    "X-Title": "ClipGenius",
+}
+
+# The prompt is: PROMPT_PREFIX + transcript + timing lines + PROMPT_SUFFIX
+PROMPT_PREFIX = """You are a video content analyst. Analyze this YouTube video transcript and find the most interesting, important, or notable moments.
 
 TRANSCRIPT:
-{transcript_text}
+"""
 
-TIMESTAMP DATA (for reference):
-The transcript has {len(transcript_segments)} segments. Each segment has a 'start' time in seconds.
-First segment starts at: {transcript_segments[0]['start']:.1f} seconds
-Last segment starts at: {transcript_segments[-1]['start']:.1f} seconds
+PROMPT_SUFFIX = """
 
 YOUR TASK:
 1. Identify 5-8 of the most interesting moments in this video
 2. For each moment, provide the approximate timestamp and a brief explanation
 
 RESPOND IN THIS EXACT JSON FORMAT (no other text):
-{{
+{
     "timestamps": [
-        {{
+        {
             "seconds": 0,
             "time": "0:00",
             "reason": "Brief explanation of why this moment is interesting"
-        }}
+        }
     ]
-}}
+}
 
 RULES:
 - Seconds must be a number (the timestamp in seconds)
@@ -65,29 +92,211 @@ RULES:
 - Order timestamps from earliest to latest
 - Only return valid JSON, no markdown or other formatting"""
 
-        # Call OpenRouter API
-        url = "https://openrouter.ai/api/v1/chat/completions"
-        
-        headers = {
-            "Authorization": f"Bearer {OPENROUTER_API_KEY}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "http://localhost:8000",
-            "X-Title": "ClipGenius",
-        }
+MODEL = "google/gemini-2.0-flash-exp:free"  # Free model!
+
+
+async def start_client() -> None:
+    """Create the shared HTTP client used for OpenRouter calls."""
+    global _client
+    if _client is None:
+        # retries= only covers connection failures; status retries are in _post
+        transport = httpx.AsyncHTTPTransport(
+            http2=True,
+            retries=MAX_RETRIES,
+            limits=httpx.Limits(
+                max_keepalive_connections=32,
+                max_connections=64,
+                keepalive_expiry=KEEPALIVE_EXPIRY,
+            ),
+        )
+        _client = httpx.AsyncClient(timeout=60, transport=transport)
+
+
+async def close_client() -> None:
+    """Close the shared HTTP client."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# Latest background connection warm-up (see warm_up), kept referenced
+_warmup_task: asyncio.Task | None = None
+
+# When OpenRouter was last contacted (request or warm-up), time.monotonic()
+_last_contact = 0.0
+
+
+async def _open_connection() -> None:
+    """Make a tiny request so the pool holds an open connection to OpenRouter."""
+    client = _client
+    if client is None:
+        return
+    try:
+        await client.head(OPENROUTER_MODELS_URL)
+    except httpx.HTTPError:
+        pass  # only an optimization; the real request will report errors
+
+
+def warm_up() -> None:
+    """
+    Start connecting to OpenRouter in the background.
+    
+    Call this before slow work that precedes an AI call (like fetching a
+    transcript) so the TCP + TLS handshake happens in the meantime.
+    Does nothing if the pool likely already has an open connection.
+    """
+    global _warmup_task, _last_contact
+    if not OPENROUTER_API_KEY or _client is None:
+        return
+    if time.monotonic() - _last_contact < KEEPALIVE_EXPIRY:
+        return
+    _last_contact = time.monotonic()
+    _warmup_task = asyncio.create_task(_open_connection())
+
+
+async def _post(url: str, **kwargs) -> httpx.Response:
+    """POST using the shared client, retrying transient gateway errors."""
+    if _client is None:
+        await start_client()
+    
+    global _last_contact
+    for attempt in range(MAX_RETRIES + 1):
+        _last_contact = time.monotonic()
+        response = await _client.post(url, **kwargs)
+        if response.status_code not in RETRY_STATUSES or attempt == MAX_RETRIES:
+            return response
+        await asyncio.sleep(RETRY_BACKOFF * (2 ** attempt))
+
+
+def _downsample(
+    transcript_text: str,
+    transcript_segments: dict,
+    target_tokens: int = TRANSCRIPT_TOKEN_BUDGET,
+) -> str:
+    """
+    Shrink a long transcript to roughly fit the token budget.
+    
+    Keeps every k-th segment so the whole video is still covered, and
+    prefixes each with its start time so the AI can place timestamps.
+    Short transcripts are returned unchanged.
+    """
+    total_tokens = len(transcript_text) // 4
+    if total_tokens <= target_tokens:
+        return transcript_text
+    
+    # Every kept segment also gets a "[Ns] " tag and a newline, so count
+    # those too (sized for the longest tag) when picking the step
+    texts = transcript_segments["texts"]
+    starts = transcript_segments["starts"]
+    tag_chars = len(f"[{starts[-1]:.0f}s] ") + 1
+    tagged_tokens = (len(transcript_text) + len(texts) * tag_chars) // 4
+    step = math.ceil(tagged_tokens / target_tokens)
+    
+    # Sampled segments can run longer than average, so step up until it fits
+    while True:
+        sampled = "\n".join(
+            f"[{start:.0f}s] {text}"
+            for start, text in zip(starts[::step].tolist(), texts[::step])
+        )
+        if len(sampled) // 4 <= target_tokens or step >= len(texts):
+            return sampled
+        step += 1
+
+
+def _json_string_body(text: str) -> bytes:
+    """Encode text as the inside of a JSON string (escaped, without quotes)."""
+    return _json_dumps(text)[1:-1]
+
+
+# Request body split around the dynamic part of the prompt and pre-encoded,
+# so each call only has to encode the transcript itself
+_BODY_START = (
+    b'{"model":' + _json_dumps(MODEL)
+    + b',"temperature":0.7,"max_tokens":2048'
+    + b',"messages":[{"role":"user","content":"' + _json_string_body(PROMPT_PREFIX)
+)
+_BODY_END = _json_string_body(PROMPT_SUFFIX) + b'"}],"stream":false}'
+_BODY_END_STREAM = _json_string_body(PROMPT_SUFFIX) + b'"}],"stream":true}'
+
+
+def _build_request(
+    transcript_text: str,
+    transcript_segments: dict,
+    stream: bool = False,
+) -> bytes:
+    """
+    Build the OpenRouter request body (JSON bytes) for a transcript.
+    
+    Only the transcript and timing lines are encoded per call; the rest
+    of the body is pre-encoded at import time.
+    """
+    # Keep long transcripts within the prompt budget
+    transcript_text = _downsample(transcript_text, transcript_segments)
+    
+    starts = transcript_segments["starts"]
+    timing = f"""
+
+TIMESTAMP DATA (for reference):
+The transcript has {len(transcript_segments['texts'])} segments. Each segment has a 'start' time in seconds.
+First segment starts at: {starts[0]:.1f} seconds
+Last segment starts at: {starts[-1]:.1f} seconds"""
+    
+    return b"".join((
+        _BODY_START,
+        _json_string_body(transcript_text),
+        _json_string_body(timing),
+        _BODY_END_STREAM if stream else _BODY_END,
+    ))
+
+
+def _parse_reply(response_text: str) -> dict:
+    """
+    Pull the JSON out of the AI's reply text.
+    
+    The JSON is returned as raw bytes ("json_bytes") so the caller can
+    parse and validate it in one step.
+    """
+    # Remove markdown code blocks if present
+    match = CODE_FENCE_PATTERN.search(response_text)
+    response_text = match.group(1) if match else response_text.strip()
+    
+    return {
+        "success": True,
+        "json_bytes": response_text.encode(),
+    }
+
+
+def _error_result(error: Exception) -> dict:
+    """Turn an exception from an AI call into an error result."""
+    if isinstance(error, json.JSONDecodeError):
+        message = f"Failed to parse AI response: {str(error)}"
+    elif isinstance(error, httpx.TimeoutException):
+        message = "AI request timed out. Please try again."
+    else:
+        message = f"AI analysis failed: {str(error)}"
+    return {"success": False, "error": message}
+
+
+async def analyze_transcript(transcript_text: str, transcript_segments: dict) -> dict:
+    """
+    Send transcript to OpenRouter AI to find interesting moments.
+    
+    Args:
+        transcript_text: The full transcript as plain text
+        transcript_segments: Segments as parallel texts/starts/durations arrays
         
-        data = {
-            "model": "google/gemini-2.0-flash-exp:free",  # Free model!
-            "messages": [
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ],
-            "temperature": 0.7,
-            "max_tokens": 2048,
-        }
+    Returns:
+        Dictionary with success status and the reply JSON bytes or error
+    """
+    if not OPENROUTER_API_KEY:
+        return dict(API_KEY_MISSING)
+    
+    try:
+        body = _build_request(transcript_text, transcript_segments)
         
-        response = requests.post(url, headers=headers, json=data, timeout=60)
+        # Call OpenRouter API
+        response = await _post(OPENROUTER_URL, headers=HEADERS, content=body)
         
         if response.status_code != 200:
             error_detail = response.json().get("error", {}).get("message", response.text)
@@ -96,42 +305,75 @@ RULES:
                 "error": f"OpenRouter API error: {error_detail}",
             }
         
-        result = response.json()
+        result = _json_loads(response.content)
         
         # Extract the text response
-        response_text = result["choices"][0]["message"]["content"].strip()
+        return _parse_reply(result["choices"][0]["message"]["content"])
         
-        # Remove markdown code blocks if present
-        if response_text.startswith("```"):
-            response_text = response_text.split("```")[1]
-            if response_text.startswith("json"):
-                response_text = response_text[4:]
-        response_text = response_text.strip()
-        
-        # Parse JSON
-        parsed = json.loads(response_text)
-        
-        return {
-            "success": True,
-            "timestamps": parsed.get("timestamps", []),
-        }
+    except Exception as e:
+        return _error_result(e)
+
+
+async def stream_transcript_analysis(
+    transcript_text: str,
+    transcript_segments: dict,
+) -> AsyncIterator[dict]:
+    """
+    Like analyze_transcript, but streams the AI reply as it is generated.
+    
+    Yields {"partial": text} for each chunk of the reply, then a final
+    result dictionary (same shape as analyze_transcript returns).
+    """
+    if not OPENROUTER_API_KEY:
+        yield dict(API_KEY_MISSING)
+        return
+    
+    if _client is None:
+        await start_client()
+    
+    global _last_contact
+    try:
+        body = _build_request(transcript_text, transcript_segments, stream=True)
+        chunks = []
         
-    except json.JSONDecodeError as e:
-        return {
-            "success": False,
-            "error": f"Failed to parse AI response: {str(e)}",
-        }
+        # OpenRouter streams Server-Sent Events: "data: {...}" lines,
+        # ending with "data: [DONE]"
+        _last_contact = time.monotonic()
+        async with _client.stream("POST", OPENROUTER_URL, headers=HEADERS, content=body) as response:
+            if response.status_code != 200:
+                await response.aread()
+                error_detail = response.json().get("error", {}).get("message", response.text)
+                yield {
+                    "success": False,
+                    "error": f"OpenRouter API error: {error_detail}",
+                }
+                return
+            
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[len("data:"):].strip()
+                if payload == "[DONE]":
+                    break
+                
+                event = _json_loads(payload)
+                if "error" in event:
+                    yield {
+                        "success": False,
+                        "error": f"OpenRouter API error: {event['error'].get('message', event['error'])}",
+                    }
+                    return
+                
+                # (some chunks, e.g. usage or keep-alives, carry no choices)
+                if not event.get("choices"):
+                    continue
+                
+                delta = event["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    chunks.append(delta)
+                    yield {"partial": delta}
         
-    except requests.exceptions.Timeout:
-        return {
-            "success": False,
-            "error": "AI request timed out. Please try again.",
-        }
+        yield _parse_reply("".join(chunks))
         
     except Exception as e:
-        return {
-            "success": False,
-            "error": f"AI analysis failed: {str(e)}",
-        }
-
-
+        yield _error_result(e)
@@ -1,36 +1,223 @@
 """
 Database Service
 Handles saving and retrieving analysis results.
-For now, uses a local JSON file. Can be upgraded to Supabase later.
+Uses a local SQLite database keyed by video ID. Can be upgraded to Supabase later.
 """
 
-import os
 import json
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+import msgpack
+import numpy as np
+import zstandard as zstd
+from cachetools import TTLCache
 from datetime import datetime
 from pathlib import Path
 
-# Path to the local cache file
-CACHE_FILE = Path(__file__).parent.parent / "cache.json"
+# orjson is much faster than the standard library; fall back if missing
+try:
+    import orjson
 
+    def _dumps(value) -> bytes:
+        return orjson.dumps(value)
+except ImportError:
+    def _dumps(value) -> bytes:
+        return json.dumps(value).encode()
 
-def _load_cache() -> dict:
-    """Load the cache from file."""
-    if CACHE_FILE.exists():
+# Path to the local cache database
+CACHE_DB = Path(__file__).parent.parent / "cache.db"
+
+# The old JSON cache file, imported once into the database if present
+LEGACY_CACHE_FILE = Path(__file__).parent.parent / "cache.json"
+
+# Bump when a table layout changes; older cache tables are dropped and rebuilt
+SCHEMA_VERSION = 2
+
+# How long a permanent transcript failure (captions disabled, missing or
+# video gone) is remembered, so retrying the same video doesn't go back to
+# YouTube for a while. Stored in the database so every server worker sees
+# the same list (and a purge clears it for all of them).
+FAILURE_TTL = 300
+
+# Stored payloads are msgpack compressed with zstd, prefixed with this
+# format byte so the encoding can change later
+PAYLOAD_VERSION = 1
+
+# One shared connection, opened on first use and guarded by a lock
+_conn: sqlite3.Connection | None = None
+_lock = threading.Lock()
+
+# In-memory cache in front of the database for hot videos. Entries also
+# keep the serialized API response so cache hits can skip re-encoding.
+_l1 = TTLCache(maxsize=1024, ttl=600)
+_l1_lock = threading.Lock()
+
+# Analysis lookups already made while handling the current request, so
+# asking again (even for a miss) doesn't go back to the database
+_request_lookups: ContextVar[dict | None] = ContextVar("request_lookups", default=None)
+
+
+def _get_connection() -> sqlite3.Connection:
+    """Open the cache database (once) and make sure the schema exists."""
+    global _conn
+    if _conn is None:
+        conn = sqlite3.connect(CACHE_DB, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        
+        # Each server worker opens the database on its own, so set up the
+        # schema in one write transaction: the version is only checked
+        # (and old tables dropped) once no other worker is mid-setup
+        conn.execute("BEGIN IMMEDIATE")
         try:
-            with open(CACHE_FILE, "r") as f:
-                return json.load(f)
-        except:
-            return {}
-    return {}
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                conn.execute("DROP TABLE IF EXISTS analyses")
+                conn.execute("DROP TABLE IF EXISTS transcripts")
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS analyses (
+                    video_id TEXT PRIMARY KEY,
+                    payload BLOB,
+                    created_at TEXT
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS transcripts (
+                    video_id TEXT PRIMARY KEY,
+                    texts BLOB,
+                    starts BLOB,
+                    durations BLOB,
+                    text TEXT
+                )
+                """
+            )
+            conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS failures (
+                    video_id TEXT PRIMARY KEY,
+                    error TEXT,
+                    expires_at REAL
+                )
+                """
+            )
+            imported = _import_legacy_cache(conn)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            conn.close()
+            raise
+        
+        if imported:
+            # Keep the file around, but don't import it again
+            try:
+                LEGACY_CACHE_FILE.rename(LEGACY_CACHE_FILE.with_suffix(".json.imported"))
+            except FileNotFoundError:
+                pass  # another worker imported it at the same time
+        _conn = conn
+    return _conn
 
 
-def _save_cache(cache: dict) -> None:
-    """Save the cache to file."""
+def _import_legacy_cache(conn: sqlite3.Connection) -> bool:
+    """
+    Copy analyses from the old cache.json into the database.
+    Returns True if the file was imported (so it can be renamed).
+    """
+    if not LEGACY_CACHE_FILE.exists():
+        return False
+    
     try:
-        with open(CACHE_FILE, "w") as f:
-            json.dump(cache, f, indent=2)
+        with open(LEGACY_CACHE_FILE, "r") as f:
+            cache = json.load(f)
+        
+        for video_id, data in cache.items():
+            # The old cache stored the AI's reply before it was validated,
+            # so skip entries that wouldn't pass the response model
+            analysis = _legacy_analysis(data)
+            if analysis is None:
+                print(f"Skipping invalid cached analysis for {video_id}")
+                continue
+            conn.execute(
+                "INSERT OR IGNORE INTO analyses VALUES (?, ?, ?)",
+                (video_id, _pack(analysis), data.get("created_at")),
+            )
+        return True
+    except FileNotFoundError:
+        return False
     except Exception as e:
-        print(f"Failed to save cache: {e}")
+        print(f"Failed to import {LEGACY_CACHE_FILE.name}: {e}")
+        return False
+
+
+def _legacy_analysis(data) -> dict | None:
+    """
+    Convert an entry from the old cache to the stored analysis format,
+    coercing types the way the response model does.
+    Returns None if the entry (or any of its timestamps) isn't valid.
+    """
+    try:
+        video_title = data.get("video_title")
+        if video_title is not None and not isinstance(video_title, str):
+            return None
+        
+        timestamps = []
+        for item in data.get("timestamps", []):
+            seconds = item["seconds"]
+            if isinstance(seconds, bool) or not isinstance(seconds, (int, float, str)):
+                return None
+            if isinstance(seconds, str):
+                seconds = float(seconds.strip())
+            if seconds != int(seconds):
+                return None
+            if not isinstance(item["time"], str) or not isinstance(item["reason"], str):
+                return None
+            timestamps.append({
+                "seconds": int(seconds),
+                "time": item["time"],
+                "reason": item["reason"],
+            })
+        return {"video_title": video_title, "timestamps": timestamps}
+    except (AttributeError, TypeError, KeyError, ValueError, OverflowError):
+        return None
+
+
+def _lookups() -> dict:
+    """Get the lookup memo for the current request (task), creating it if needed."""
+    lookups = _request_lookups.get()
+    if lookups is None:
+        lookups = {}
+        _request_lookups.set(lookups)
+    return lookups
+
+
+def _pack(value) -> bytes:
+    """Encode a value for storage (version byte + zstd-compressed msgpack)."""
+    compressed = zstd.ZstdCompressor(level=3).compress(msgpack.packb(value))
+    return bytes([PAYLOAD_VERSION]) + compressed
+
+
+def _unpack(blob: bytes):
+    """Decode a value stored with _pack."""
+    if blob[0] != PAYLOAD_VERSION:
+        raise ValueError(f"Unknown payload version: {blob[0]}")
+    return msgpack.unpackb(zstd.ZstdDecompressor().decompress(blob[1:]))
+
+
+def _cache_entry(data: dict) -> dict:
+    """Build an in-memory cache entry, including the pre-serialized response."""
+    response = _dumps({
+        "success": True,
+        "video_id": data["video_id"],
+        "video_title": data["video_title"] or "Unknown",
+        "timestamps": data["timestamps"],
+        "cached": True,
+        "error": None,
+    })
+    return {"data": data, "response": response}
 
 
 def save_analysis(video_id: str, video_title: str, timestamps: list) -> dict:
@@ -46,16 +233,27 @@ def save_analysis(video_id: str, video_title: str, timestamps: list) -> dict:
         Dictionary with success status
     """
     try:
-        cache = _load_cache()
-        
-        cache[video_id] = {
+        data = {
             "video_id": video_id,
             "video_title": video_title,
             "timestamps": timestamps,
             "created_at": datetime.utcnow().isoformat(),
         }
         
-        _save_cache(cache)
+        with _lock:
+            _get_connection().execute(
+                "INSERT OR REPLACE INTO analyses VALUES (?, ?, ?)",
+                (
+                    video_id,
+                    _pack({"video_title": video_title, "timestamps": timestamps}),
+                    data["created_at"],
+                ),
+            )
+        
+        entry = _cache_entry(data)
+        with _l1_lock:
+            _l1[video_id] = entry
+        _lookups()[video_id] = {"found": True, **entry}
         return {"success": True}
         
     except Exception as e:
@@ -73,15 +271,104 @@ def get_cached_analysis(video_id: str) -> dict:
         video_id: YouTube video ID
         
     Returns:
-        Dictionary with cached data if found, or None
+        Dictionary with cached data (and the serialized response) if found
     """
+    lookups = _lookups()
+    if video_id in lookups:
+        return lookups[video_id]
+    
     try:
-        cache = _load_cache()
+        with _l1_lock:
+            entry = _l1.get(video_id)
+        
+        if entry is None:
+            with _lock:
+                row = _get_connection().execute(
+                    "SELECT payload, created_at FROM analyses WHERE video_id = ?",
+                    (video_id,),
+                ).fetchone()
+            
+            if row:
+                payload, created_at = row
+                data = {
+                    "video_id": video_id,
+                    **_unpack(payload),
+                    "created_at": created_at,
+                }
+                entry = _cache_entry(data)
+                with _l1_lock:
+                    _l1[video_id] = entry
         
-        if video_id in cache:
+        result = {"found": True, **entry} if entry is not None else {"found": False}
+        lookups[video_id] = result
+        return result
+        
+    except Exception as e:
+        return {"found": False}
+
+
+def save_transcript(video_id: str, transcript: dict, full_text: str) -> dict:
+    """
+    Save a fetched transcript so the video can be re-analyzed without
+    hitting YouTube again.
+    
+    Args:
+        video_id: YouTube video ID
+        transcript: Segments as parallel texts/starts/durations arrays
+        full_text: Full transcript as plain text
+        
+    Returns:
+        Dictionary with success status
+    """
+    try:
+        # Timing arrays are stored as raw float32 bytes
+        texts = _pack(transcript["texts"])
+        starts = np.asarray(transcript["starts"], dtype=np.float32).tobytes()
+        durations = np.asarray(transcript["durations"], dtype=np.float32).tobytes()
+        
+        with _lock:
+            _get_connection().execute(
+                "INSERT OR REPLACE INTO transcripts VALUES (?, ?, ?, ?, ?)",
+                (video_id, texts, starts, durations, full_text),
+            )
+        return {"success": True}
+        
+    except Exception as e:
+        return {
+            "success": False,
+            "error": f"Failed to save transcript: {str(e)}",
+        }
+
+
+def get_cached_transcript(video_id: str) -> dict:
+    """
+    Check if we already have the transcript for this video.
+    
+    Args:
+        video_id: YouTube video ID
+        
+    Returns:
+        Dictionary with the transcript segments and text if found
+    """
+    try:
+        with _lock:
+            row = _get_connection().execute(
+                "SELECT texts, starts, durations, text FROM transcripts WHERE video_id = ?",
+                (video_id,),
+            ).fetchone()
+        
+        if row:
+            texts, starts, durations, text = row
             return {
                 "found": True,
-                "data": cache[video_id],
+                "data": {
+                    "transcript": {
+                        "texts": _unpack(texts),
+                        "starts": np.frombuffer(starts, dtype=np.float32),
+                        "durations": np.frombuffer(durations, dtype=np.float32),
+                    },
+                    "text": text,
+                },
             }
         
         return {"found": False}
@@ -89,3 +376,57 @@ def get_cached_analysis(video_id: str) -> dict:
     except Exception as e:
         return {"found": False}
 
+
+def get_cached_failure(video_id: str) -> dict | None:
+    """Return the recent failed transcript fetch for this video, if any."""
+    try:
+        with _lock:
+            row = _get_connection().execute(
+                "SELECT error FROM failures WHERE video_id = ? AND expires_at > ?",
+                (video_id, time.time()),
+            ).fetchone()
+        
+        if row:
+            return {"success": False, "error": row[0]}
+        return None
+        
+    except Exception as e:
+        return None
+
+
+def cache_failure(video_id: str, result: dict) -> None:
+    """Remember a failed transcript fetch, if it's one that retrying won't fix."""
+    if not result.get("permanent"):
+        return
+    
+    try:
+        now = time.time()
+        with _lock:
+            conn = _get_connection()
+            conn.execute("DELETE FROM failures WHERE expires_at <= ?", (now,))
+            conn.execute(
+                "INSERT OR REPLACE INTO failures VALUES (?, ?, ?)",
+                (video_id, result["error"], now + FAILURE_TTL),
+            )
+    except Exception as e:
+        print(f"Failed to remember transcript failure: {e}")
+
+
+def purge_failures(video_id: str | None = None) -> int:
+    """
+    Forget remembered transcript failures so the video(s) can be retried.
+    Clears everything if no video ID is given. Returns how many were removed.
+    """
+    now = time.time()
+    with _lock:
+        conn = _get_connection()
+        if video_id is None:
+            cursor = conn.execute("DELETE FROM failures WHERE expires_at > ?", (now,))
+        else:
+            cursor = conn.execute(
+                "DELETE FROM failures WHERE video_id = ? AND expires_at > ?",
+                (video_id, now),
+            )
+        count = cursor.rowcount
+        conn.execute("DELETE FROM failures WHERE expires_at <= ?", (now,))
+    return count
@@ -4,7 +4,30 @@ Handles extracting video ID and fetching transcripts from YouTube videos.
 """
 
 import re
-from youtube_transcript_api import YouTubeTranscriptApi
+import numpy as np
+from youtube_transcript_api import (
+    YouTubeTranscriptApi,
+    TranscriptsDisabled,
+    NoTranscriptFound,
+    VideoUnavailable,
+    VideoUnplayable,
+    InvalidVideoId,
+)
+
+# Matches watch, embed and youtu.be links in a single pass
+VIDEO_ID_PATTERN = re.compile(
+    r'(?:youtube\.com/(?:watch\?v=|embed/)|youtu\.be/)([a-zA-Z0-9_-]{11})'
+)
+
+# Errors that mean the video itself has no usable transcript. Anything
+# else (request failures, blocked IPs, ...) may work on a retry.
+PERMANENT_ERRORS = (
+    TranscriptsDisabled,
+    NoTranscriptFound,
+    VideoUnavailable,
+    VideoUnplayable,
+    InvalidVideoId,
+)
 
 
 def extract_video_id(youtube_url: str) -> str | None:
@@ -18,19 +41,8 @@ def extract_video_id(youtube_url: str) -> str | None:
     
     Returns None if no valid video ID is found.
     """
-    # Pattern to match YouTube video IDs
-    patterns = [
-        r'(?:youtube\.com\/watch\?v=)([a-zA-Z0-9_-]{11})',
-        r'(?:youtu\.be\/)([a-zA-Z0-9_-]{11})',
-        r'(?:youtube\.com\/embed\/)([a-zA-Z0-9_-]{11})',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, youtube_url)
-        if match:
-            return match.group(1)
-    
-    return None
+    match = VIDEO_ID_PATTERN.search(youtube_url)
+    return match.group(1) if match else None
 
 
 def fetch_transcript(video_id: str) -> dict:
@@ -39,53 +51,64 @@ def fetch_transcript(video_id: str) -> dict:
     
     Returns a dictionary with:
     - success: True/False
-    - transcript: List of transcript segments (if successful)
+    - transcript: Segments as parallel "texts", "starts" and "durations"
+      arrays (if successful)
     - text: Full transcript as plain text (if successful)
     - error: Error message (if failed)
+    - permanent: True if retrying won't help (if failed)
     """
     try:
         # Fetch the transcript using the new v1.x API
         ytt_api = YouTubeTranscriptApi()
         transcript_data = ytt_api.fetch(video_id)
         
-        # Convert to list of dicts with text, start, duration
-        transcript_list = []
-        for snippet in transcript_data.snippets:
-            transcript_list.append({
-                "text": snippet.text,
-                "start": snippet.start,
-                "duration": snippet.duration,
-            })
+        # Store segments as parallel arrays (texts, starts, durations),
+        # which is far more compact than one dict per segment
+        snippets = transcript_data.snippets
+        transcript = {
+            "texts": [snippet.text for snippet in snippets],
+            "starts": np.fromiter(
+                (snippet.start for snippet in snippets), dtype=np.float32, count=len(snippets)
+            ),
+            "durations": np.fromiter(
+                (snippet.duration for snippet in snippets), dtype=np.float32, count=len(snippets)
+            ),
+        }
         
         # Combine all text segments into full transcript
-        full_text = " ".join([segment["text"] for segment in transcript_list])
+        full_text = " ".join(transcript["texts"])
         
         return {
             "success": True,
-            "transcript": transcript_list,
+            "transcript": transcript,
             "text": full_text,
         }
         
     except Exception as e:
         error_msg = str(e).lower()
+        permanent = isinstance(e, PERMANENT_ERRORS)
         
         if "disabled" in error_msg:
             return {
                 "success": False,
                 "error": "Transcripts are disabled for this video.",
+                "permanent": permanent,
             }
         elif "no transcript" in error_msg or "not found" in error_msg:
             return {
                 "success": False,
                 "error": "No transcript found for this video. It might not have captions.",
+                "permanent": permanent,
             }
         elif "unavailable" in error_msg or "private" in error_msg:
             return {
                 "success": False,
                 "error": "Video is unavailable. It might be private or deleted.",
+                "permanent": permanent,
             }
         else:
             return {
                 "success": False,
                 "error": f"Failed to fetch transcript: {str(e)}",
+                "permanent": permanent,
             }